@@ -20,6 +20,10 @@ class QueryOutputLine(BaseModel):
 
 class Query(Generic[QueryInT, QueryOutT]):
 
+    # The number of recent results to keep for identical inputs, set this on queries that
+    # serve read-mostly data. 0 disables the cache.
+    cache_size = 0
+
     def __init__(self):
         """ The constructor, override it if you need to. """
         pass
@@ -50,8 +54,9 @@ class Query(Generic[QueryInT, QueryOutT]):
 
     @abstractmethod
     def outputs(self) -> Type[QueryOutT]:
-        """ return a list of text column names that will be returned by the fetch function.
-            return None if the outputs are dynamic and you want those to be inferred.
+        """ return the pydantic model of the results returned by the fetch function, which is used to
+            serialize them efficiently. Returning a Union, a list of column names or None is still
+            supported, in which case each result is serialized by its own model.
         """
         pass
 
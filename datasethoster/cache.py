@@ -0,0 +1,30 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """ A small thread safe least recently used cache, used to keep the results of recent queries. """
+
+    __slots__ = ("size", "entries", "lock")
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        """ Return the value stored for key and mark it as most recently used, or default if it isn't cached. """
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self.entries[key]
+
+    def put(self, key, value):
+        """ Store the value for key, evicting the least recently used entry if the cache is full. """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
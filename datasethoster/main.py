@@ -1,42 +1,120 @@
+import logging
 import os
-import traceback
+import types
 from collections import defaultdict
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache, update_wrapper
+from itertools import groupby, islice
+from typing import Any, Union, get_args, get_origin
 from urllib.parse import urlencode
 
+import orjson
 import sentry_sdk
-from flask import Blueprint, Flask, render_template, request, jsonify, redirect, Response
-from pydantic import BaseModel
-from sentry_sdk.integrations.flask import FlaskIntegration
+from flask import Blueprint, Flask, current_app, render_template, request, jsonify, redirect, Response, url_for
+from flask.json.provider import DefaultJSONProvider
+from pydantic import BaseModel, SerializeAsAny, TypeAdapter
 from werkzeug.exceptions import BadRequest, MethodNotAllowed
 
 from datasethoster import RequestSource, QueryOutputLine
+from datasethoster.cache import LRUCache
 from datasethoster.decorators import crossdomain
 from datasethoster.exceptions import RedirectError
 
 
-class QueryOutputWrapperModel(BaseModel):
-    __root__: list[BaseModel]
-
+logger = logging.getLogger(__name__)
 
 DEFAULT_QUERY_RESULT_SIZE = 100
+DEFAULT_MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+JSON_STREAM_CHUNK_SIZE = 1000
+OFFSET_COUNT_ERROR = "offset and count arguments are only supported for the POST method"
 TEMPLATE_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "template")
 
 
+class _QuerySpec:
+    """ Everything about a registered query that does not change after setup(), looked up once
+        at registration time so that the request handlers don't have to ask the query again.
+    """
+
+    __slots__ = ("query", "slug", "desc", "intro", "input_model", "input_names", "inputs_adapter", "fields",
+                 "outputs_adapter", "cache")
+
+    def __init__(self, query):
+        self.query = query
+        self.slug, self.desc = query.names()
+        self.intro = query.introduction()
+        self.input_model = query.inputs()
+        self.input_names = frozenset(self.input_model.model_fields)
+        self.inputs_adapter = TypeAdapter(list[self.input_model])
+        self.fields = make_field_specs(self.input_model)
+        self.outputs_adapter = make_outputs_adapter(query)
+        self.cache = LRUCache(query.cache_size) if query.cache_size else None
+
+
 registered_queries = {}
 
+# X | Y annotations only have their own type from python 3.10 onwards
+_UNION_TYPES = (Union, getattr(types, "UnionType", Union))
+
+# Marks a cache miss, since None is a valid cached value
+_MISSING = object()
+
 
 dataset_bp = Blueprint('dataset_hoster', __name__, template_folder=TEMPLATE_FOLDER)
 
 
+def field_type(field):
+    """ Return the type of a model field, unwrapping Optional[...] annotations. """
+    annotation = field.annotation
+    if get_origin(annotation) in _UNION_TYPES:
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """ A JSON provider that uses orjson, so that jsonify and request.json use it as well. """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def is_class(annotation):
+    """ Check whether a field annotation is a plain class. Parametrized generics like list[str] are
+        excluded, since issubclass() raises a TypeError for them on python 3.10.
+    """
+    return isinstance(annotation, type) and get_origin(annotation) is None
+
+
+def make_field_specs(input_model: type[BaseModel]):
+    """ Describe the form widget for each of the input model's fields, so that the query page
+        template doesn't need to inspect the field types on every render.
+    """
+    fields = []
+    for name, field in input_model.model_fields.items():
+        annotation = field_type(field)
+        if is_class(annotation) and issubclass(annotation, Enum):
+            fields.append({"name": name, "kind": "select", "choices": [option.value for option in annotation]})
+        elif annotation is datetime:
+            fields.append({"name": name, "kind": "datetime"})
+        else:
+            fields.append({"name": name, "kind": "text"})
+    return fields
+
+
 def create_app(config_file=None):
     """Create a flask app and optionally load a config file and initialise sentry"""
     app = Flask(__name__, template_folder=TEMPLATE_FOLDER)
-    app.jinja_env.tests["datetime_field"] = lambda f: f.type_ == datetime
-    app.jinja_env.tests["select_field"] = lambda f: issubclass(f.type_, Enum)
+    app.json = OrjsonProvider(app)
     app.jinja_env.filters["zip"] = zip
     app.register_blueprint(dataset_bp)
+    # reject oversized POST bodies from their Content-Length, before reading them. Set before loading
+    # the config, so that a config can still change the limit or disable it with None.
+    app.config["MAX_CONTENT_LENGTH"] = DEFAULT_MAX_CONTENT_LENGTH
     if config_file:
         app.config.from_object(config_file)
     init_sentry(app)
@@ -46,6 +124,8 @@ def create_app(config_file=None):
 def init_sentry(app, dsn_config='SENTRY_DSN'):
     """Register sentry on the given app"""
     if dsn_config in app.config and app.config[dsn_config]:
+        # only pay for importing the flask integration when sentry is actually used
+        from sentry_sdk.integrations.flask import FlaskIntegration
         sentry_sdk.init(
             dsn=app.config[dsn_config],
             integrations=[FlaskIntegration()]
@@ -54,6 +134,28 @@ def init_sentry(app, dsn_config='SENTRY_DSN'):
     return app
 
 
+def make_outputs_adapter(query):
+    """ Build a type adapter for the list of results returned by the query, so that the output type
+        is resolved once at registration time rather than on every request.
+    """
+    output_model = query.outputs()
+    if is_class(output_model) and issubclass(output_model, BaseModel):
+        # SerializeAsAny keeps the fields of subclasses, like the untyped list of models did
+        return TypeAdapter(list[SerializeAsAny[output_model]])
+    # column name lists, unions or None: serialize each result by its runtime type
+    return TypeAdapter(list[Any])
+
+
+def bind_query_spec(handler, spec):
+    """ Return a view function that calls the handler with the given query spec, so that flask's
+        routing already selects the query and no lookup is needed per request.
+    """
+    def view():
+        return handler(spec)
+
+    return update_wrapper(view, handler)
+
+
 def register_query(query):
     """
         Applications that use this library must call this function for each query it wishes to host,
@@ -61,10 +163,12 @@ def register_query(query):
     """
 
     query.setup()
-    slug, name = query.names()
-    registered_queries[slug] = query
-    dataset_bp.add_url_rule('/%s' % slug, slug, web_query_handler)
-    dataset_bp.add_url_rule('/%s/json' % slug, slug + "_json", json_query_handler, methods=['GET', 'POST', 'OPTIONS'])
+    spec = _QuerySpec(query)
+    slug = spec.slug
+    registered_queries[slug] = spec
+    dataset_bp.add_url_rule('/%s' % slug, slug, bind_query_spec(web_query_handler, spec))
+    dataset_bp.add_url_rule('/%s/json' % slug, slug + "_json", bind_query_spec(json_query_handler, spec),
+                            methods=['GET', 'POST', 'OPTIONS'])
 
 
 @dataset_bp.route('/')
@@ -73,63 +177,81 @@ def index():
     return render_template("index.html", queries=registered_queries)
 
 
-@dataset_bp.errorhandler(404)
-def page_not_found(e):
-    return render_template('error.html', error="Query not found."), 404
-
-
-def fetch_query(url):
-    """ 
-        Helper function to lookup and return a query object. Return None and error string
-        if not query is found. Otherwise query and an empty error string.
+def render_static_error(error):
+    """ Render the error page for an error message that never changes once per app, and return the
+        stored page on later calls.
     """
-    parts = url[1:].split("/")
-    slug = parts[0]
-    try:
-        query = registered_queries[slug]
-    except KeyError:
-        return None, "Requested query '%s' not hosted on this site." % slug
+    pages = current_app.extensions.setdefault("datasethoster_error_pages", {})
+    page = pages.get(error)
+    if page is None:
+        page = pages[error] = render_template("error.html", error=error)
+    return page
 
-    return query, ""
+
+@dataset_bp.errorhandler(404)
+def page_not_found(e):
+    return render_static_error("Query not found."), 404
 
 
 def fetch_matching_queries(columns: list[str]):
     """ Retrieve queries one of whose input names matches the given column name """
     columns = set(columns)
     matches = []
-    for query in registered_queries.values():
-        input_model = query.inputs()
-        inputs = set(input_model.__fields__.keys())
-        matching_columns = columns.intersection(inputs)
+    for spec in registered_queries.values():
+        matching_columns = columns.intersection(spec.input_names)
         if matching_columns:
-            matches.append((query, matching_columns))
+            matches.append((spec, matching_columns))
     return matches
 
 
 def get_links_for_output(columns, data):
     """ Generate links to launch other queries for each output item in the data """
     matches = fetch_matching_queries(columns)
+    if not matches:
+        return [{} for _ in data]
+
     urls = []
     for row in data:
         row_urls = defaultdict(list)
-        for (query, columns) in matches:
-            slug, name = query.names()
+        for (spec, columns) in matches:
             params = {column: row[column] for column in columns}
             params["dryrun"] = True
-            url = f"{slug}?{urlencode(params)}"
+            url = f"{spec.slug}?{urlencode(params)}"
             for column in columns:
-                row_urls[column].append((name, url))
+                row_urls[column].append((spec.desc, url))
         urls.append(row_urls)
     return urls
 
 
+@lru_cache(maxsize=128)
+def has_plain_fields(model: type[BaseModel]):
+    """ Check whether the model has no custom serializers, computed fields or extra fields and none
+        of its fields hold nested models, in which case the instance dict already matches what
+        .model_dump() would return.
+    """
+    decorators = model.__pydantic_decorators__
+    if decorators.field_serializers or decorators.model_serializers or decorators.computed_fields:
+        return False
+    if model.model_config.get("extra") == "allow":
+        return False
+    for field in model.model_fields.values():
+        if not is_class(field.annotation) or issubclass(field.annotation, BaseModel):
+            return False
+    return True
+
+
 def convert_result_group_to_output(groups: list[tuple[list[str], list[BaseModel]]]):
     """ Convert the result columns and data into an output group by adding similar urls if any """
     outputs = []
     for columns, values in groups:
+        if has_plain_fields(type(values[0])):
+            # copy the dicts so that the templates never see the live (possibly cached) instances
+            data = [x.__dict__.copy() for x in values]
+        else:
+            data = [x.model_dump() for x in values]
         output = {
             "columns": columns,
-            "data": [x.dict() for x in values],
+            "data": data,
             "no_table": isinstance(values[0], QueryOutputLine)
         }
         if not output["no_table"]:
@@ -139,55 +261,84 @@ def convert_result_group_to_output(groups: list[tuple[list[str], list[BaseModel]
 
 
 def group_results(results):
-    """ Create groups, consecutive outputs till their column list doesn't change, from results """
+    """ Create groups of consecutive results that share the same output model, and so the same columns """
     if not results:
         return []
 
-    groups = []
-    last_result, last_keys, last_group = results[0], results[0].__fields__.keys(), []
-    for result in results:
-        current_keys = result.__fields__.keys()
-        if current_keys != last_keys:
-            groups.append((last_keys, last_group))
-            last_keys, last_group = current_keys, []
-        last_result = result
-        last_group.append(result)
-
-    if last_result and last_keys and last_group:
-        groups.append((last_keys, last_group))
+    # most queries return a single output model, which needs no grouping at all
+    model = type(results[0])
+    if all(type(result) is model for result in results):
+        return [(list(model.model_fields), results)]
 
+    groups = []
+    for model, values in groupby(results, key=type):
+        groups.append((list(model.model_fields), list(values)))
     return groups
 
 
-def web_query_handler():
+def fetch_results(spec, inputs, source, serialize=None, **kwargs):
+    """
+        Run the query for the given inputs, passing the results through serialize if given. If the
+        query has a cache, the serialized results are kept there so that repeated requests with the
+        same inputs skip both the fetch and the serialization.
+    """
+    if spec.cache is None:
+        results = spec.query.fetch(inputs, source, **kwargs)
+        return serialize(spec, results) if serialize else results
+
+    key = (source, tuple(sorted(kwargs.items())), spec.inputs_adapter.dump_json(inputs))
+    value = spec.cache.get(key, _MISSING)
+    if value is _MISSING:
+        results = spec.query.fetch(inputs, source, **kwargs)
+        value = serialize(spec, results) if serialize else list(results)
+        spec.cache.put(key, value)
+    return value
+
+
+def get_int_arg(name, default):
+    """ Return the integer value of a query string argument, or default if it is absent. Raise
+        BadRequest if the argument is present but isn't an integer.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest("The %s argument must be an integer." % name)
+
+
+def web_query_handler(spec):
     """
         This is the view handler for the web page. It is more complex because of all
         the guff shown on the web page to make it easy to discover these data sets.
     """
-    query, error = fetch_query(request.path)
-    if error:
-        return render_template("error.html", error=error)
-
-    offset = int(request.args.get('offset', "-1"))
-    count = int(request.args.get('count', "-1"))
+    try:
+        offset = get_int_arg('offset', -1)
+        count = get_int_arg('count', -1)
+    except BadRequest as err:
+        return render_template("error.html", error=err.description)
     if offset >= 0 or count >= 0:
-        return render_template("error.html", error="offset and count arguments are only supported for the POST method")
+        return render_static_error(OFFSET_COUNT_ERROR)
     dryrun = request.args.get("dryrun", None)
 
-    slug, desc = query.names()
-    introduction = query.introduction()
-    input_model = query.inputs()
-    json_url = request.url.replace(slug, slug + "/json")
+    slug = spec.slug
+    input_model = spec.input_model
+    json_url = url_for("dataset_hoster.%s_json" % slug)
+    if request.query_string:
+        json_url += "?" + request.query_string.decode()
 
+    error = ""
     outputs = []
     json_post = ""
     if request.args and not dryrun:
         try:
             inputs = [input_model(**request.args)]
-            results = query.fetch(inputs, RequestSource.web)
+            results = fetch_results(spec, inputs, RequestSource.web)
         except RedirectError as red:
             return redirect(red.url)
         except Exception as err:
+            import traceback
             error = traceback.format_exc()
             sentry_sdk.capture_exception(err)
             return render_template("error.html", error=error)
@@ -195,99 +346,133 @@ def web_query_handler():
         groups = group_results(results)
         outputs = convert_result_group_to_output(groups)
 
-        json_post = QueryOutputWrapperModel(__root__=inputs).json(indent=4)
+        json_post = orjson.dumps(
+            [x.model_dump() for x in inputs],
+            default=json_default,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        ).decode()
 
     return render_template(
         "query.html",
         error=error,
-        fields=input_model.__fields__.values(),
+        fields=spec.fields,
         results=outputs,
-        introduction=introduction,
+        introduction=spec.intro,
         args=request.args,
-        desc=desc,
+        desc=spec.desc,
         slug=slug,
         json_url=json_url,
         json_post=json_post,
-        additional_data=query.additional_data()
+        additional_data=spec.query.additional_data()
     )
 
 
 @crossdomain(headers=["Content-Type"])
-def json_query_handler():
+def json_query_handler(spec):
     """
         Disambiguate between GET and POST requests and direct accordingly.
     """
 
     if request.method == 'GET':
-        return json_query_handler_get()
+        return json_query_handler_get(spec)
 
     if request.method == 'POST':
-        return json_query_handler_post()
+        return json_query_handler_post(spec)
 
     raise MethodNotAllowed
 
 
-def json_query_handler_get():
+def json_default(obj):
+    """ Serialize the types orjson does not handle natively, such as sets and Decimals. """
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+
+def encode_results(spec, data: list[BaseModel]):
+    """ Serialize the whole list of query results to JSON in a single call into pydantic's core. """
+    return spec.outputs_adapter.dump_json(data)
+
+
+def encode_result_chunks(spec, data: list[BaseModel]):
+    """ Serialize the query results in chunks that together form a single JSON list, so that large
+        result sets can be streamed and are never held in memory as one encoded string.
+    """
+    results = iter(data)
+    separator = b"["
+    while chunk := list(islice(results, JSON_STREAM_CHUNK_SIZE)):
+        # strip the brackets of each encoded chunk to splice them into a single list
+        yield separator + spec.outputs_adapter.dump_json(chunk)[1:-1]
+        separator = b","
+    yield b"]" if separator == b"," else b"[]"
+
+
+def stream_result_chunks(spec, first_chunk, chunks):
+    """ Yield the encoded result chunks of a streamed response. The later chunks are encoded after the
+        response status has been sent, so an error there can only be reported and the response
+        aborted, which leaves the client with a truncated body.
+    """
+    yield first_chunk
+    try:
+        yield from chunks
+    except Exception as err:
+        sentry_sdk.capture_exception(err)
+        logger.exception("Streaming the results of query '%s' failed", spec.slug)
+        raise
+
+
+def json_query_handler_get(spec):
     """
         Handle a GET request. GET request should only ever be used if you're
         certain that you're not going to request a result with too many
         query parameters. If you need more than a handful of parameters,
         use the POST method instead.
     """
-    query, error = fetch_query(request.path)
-    if error:
-        raise BadRequest(error)
-
-    offset = int(request.args.get('offset', "-1"))
-    count = int(request.args.get('count', "-1"))
+    offset = get_int_arg('offset', -1)
+    count = get_int_arg('count', -1)
     if offset >= 0 or count >= 0:
-        raise BadRequest("offset and count arguments are only supported for the POST method")
-
-    input_model = query.inputs()
+        raise BadRequest(OFFSET_COUNT_ERROR)
 
     try:
-        inputs = [input_model(**request.args)]
+        inputs = [spec.input_model(**request.args)]
     except Exception as e:
         raise BadRequest(str(e))
 
     try:
-        data = query.fetch(inputs, RequestSource.json_get)
-        result = QueryOutputWrapperModel(__root__=data)
+        body = fetch_results(spec, inputs, RequestSource.json_get, serialize=encode_results)
     except Exception as err:
         sentry_sdk.capture_exception(err)
-        print(traceback.format_exc())
+        logger.exception("Query '%s' failed", spec.slug)
         return jsonify({}), 500
 
-    return Response(result.json(), mimetype="application/json")
+    return Response(body, mimetype="application/json")
 
 
-def json_query_handler_post():
+def json_query_handler_post(spec):
     """
         The POST view handler. Sanity check parameters, run the query and return it.
         Simple!
     """
-    query, error = fetch_query(request.path)
-    if error:
-        raise BadRequest(error)
-
-    input_model = query.inputs()
-
-    inputs = []
+    raw = request.get_data(cache=False)
     try:
-        for item in request.json:
-            inputs.append(input_model(**item))
+        # parse and validate the whole body in one pass in pydantic's core, rather than going
+        # through flask's request.json and one input model at a time
+        inputs = spec.inputs_adapter.validate_json(raw)
     except Exception as e:
         raise BadRequest(str(e))
 
-    offset = int(request.args.get('offset', "0"))
-    count = int(request.args.get('count', str(DEFAULT_QUERY_RESULT_SIZE)))
+    offset = get_int_arg('offset', 0)
+    count = get_int_arg('count', DEFAULT_QUERY_RESULT_SIZE)
 
     try:
-        data = query.fetch(inputs, RequestSource.json_post, offset=offset, count=count)
-        result = QueryOutputWrapperModel(__root__=data)
+        data = list(fetch_results(spec, inputs, RequestSource.json_post, offset=offset, count=count))
+        chunks = encode_result_chunks(spec, data)
+        # encode the first chunk before the response starts, so that fetch errors and errors in the
+        # first JSON_STREAM_CHUNK_SIZE results still get an error response
+        first_chunk = next(chunks)
     except Exception as err:
         sentry_sdk.capture_exception(err)
-        print(traceback.format_exc())
+        logger.exception("Query '%s' failed", spec.slug)
         return jsonify({"error": err}), 400
 
-    return Response(result.json(), mimetype="application/json")
+    return Response(stream_result_chunks(spec, first_chunk, chunks), mimetype="application/json")
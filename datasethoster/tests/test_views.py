@@ -1,11 +1,39 @@
 import unittest.mock
+from datetime import datetime
+from enum import Enum
+from typing import Optional
 from unittest.mock import patch, call
 
 import flask_testing
-from flask import current_app, url_for
+from flask import Flask, url_for
+from pydantic import BaseModel, ConfigDict, field_serializer
 
-from datasethoster import Query
-from datasethoster.main import create_app, dataset_bp, register_query, web_query_handler, json_query_handler
+from datasethoster import Query, RequestSource
+from datasethoster.main import (
+    DEFAULT_MAX_CONTENT_LENGTH,
+    create_app,
+    dataset_bp,
+    group_results,
+    json_query_handler,
+    make_outputs_adapter,
+    register_query,
+    registered_queries,
+    web_query_handler,
+)
+
+
+class SampleInputModel(BaseModel):
+    in_0: str
+    in_1: list[str] = []
+
+
+class SampleOutputModel(BaseModel):
+    out_0: str
+    out_1: list[str]
+
+
+class SampleExtendedOutputModel(SampleOutputModel):
+    out_2: int
 
 
 class SampleQuery(Query):
@@ -26,20 +54,84 @@ class SampleQuery(Query):
         return SampleInputModel
 
     def outputs(self):
-        return ['out_0', '[out_1]']
+        return SampleOutputModel
 
-    def fetch(self, params, count=25, offset=0):
+    def fetch(self, params, source, offset=-1, count=-1):
         if count == -1:
             count = 25
         if offset == -1:
             offset = 0
 
         ret = []
-        for param in params[offset:count]:
-            ret.append({ 'out_0': param['in_0'], '[out_1]': param['[in_1]'] })
+        for param in params[offset:offset + count]:
+            ret.append(SampleOutputModel(out_0=param.in_0, out_1=param.in_1))
         return ret
 
 
+class SampleColumnsQuery(SampleQuery):
+    """ A query that declares its outputs as column names, and returns a subclass of its output model. """
+
+    def names(self):
+        return ("test-columns", "test-columns-endpoint")
+
+    def outputs(self):
+        return ['out_0', '[out_1]']
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        return [SampleExtendedOutputModel(out_0=param.in_0, out_1=param.in_1, out_2=1) for param in params]
+
+
+class SampleOtherOutputModel(BaseModel):
+    total: int
+
+
+class SampleSameFieldsOutputModel(BaseModel):
+    out_0: str
+    out_1: list[str]
+
+
+class SampleColor(Enum):
+    red = "red"
+    blue = "blue"
+
+
+class SampleShape(Enum):
+    circle = "circle"
+    square = "square"
+
+
+class SampleWidgetsInputModel(BaseModel):
+    color: SampleColor
+    shape: Optional[SampleShape] = None
+    when: datetime
+
+
+class SampleWidgetsQuery(SampleQuery):
+
+    def names(self):
+        return ("test-widgets", "test-widgets-endpoint")
+
+    def inputs(self):
+        return SampleWidgetsInputModel
+
+
+class SampleCachedQuery(SampleQuery):
+    cache_size = 10
+
+    def names(self):
+        return ("test-cached", "test-cached-endpoint")
+
+
+# Queries have to be registered before the app is created, since flask doesn't allow adding
+# urls to a blueprint that was already registered on an app.
+sample_query = SampleQuery()
+register_query(sample_query)
+register_query(SampleColumnsQuery())
+register_query(SampleWidgetsQuery())
+cached_query = SampleCachedQuery()
+register_query(cached_query)
+
+
 class MainTestCase(flask_testing.TestCase):
 
     def create_app(self):
@@ -47,6 +139,7 @@ class MainTestCase(flask_testing.TestCase):
 
     def setUp(self):
         flask_testing.TestCase.setUp(self)
+        registered_queries['test-cached'].cache.entries.clear()
 
     def tearDown(self):
         flask_testing.TestCase.tearDown(self)
@@ -56,9 +149,11 @@ class MainTestCase(flask_testing.TestCase):
 
         q = SampleQuery()
         register_query(q)
-        calls = [call("/test", "test", web_query_handler), 
-                 call("/test/json", "test_json", json_query_handler, methods=['GET', 'POST', 'OPTIONS'])]
+        calls = [call("/test", "test", unittest.mock.ANY),
+                 call("/test/json", "test_json", unittest.mock.ANY, methods=['GET', 'POST', 'OPTIONS'])]
         add.assert_has_calls(calls)
+        self.assertEqual(add.call_args_list[0].args[2].__wrapped__, web_query_handler)
+        self.assertEqual(add.call_args_list[1].args[2].__wrapped__, json_query_handler)
 
     def test_index_page(self):
         resp = self.client.get(url_for('dataset_hoster.index'))
@@ -69,107 +164,328 @@ class MainTestCase(flask_testing.TestCase):
         self.assert404(resp)
 
     def test_empty_query_page(self):
-        q = SampleQuery()
-        register_query(q)
-        # Delete the blueprint so that it can be re-registered with the urls that were added with SampleQuery
-        del self.app.blueprints['dataset_hoster']
-        dataset_bp.register(current_app, {})
-
         resp = self.client.get(url_for('dataset_hoster.test'))
         self.assert200(resp)
 
+        # in_0 is required
         resp = self.client.get(url_for('dataset_hoster.test_json'))
         self.assert400(resp)
 
         resp = self.client.post(url_for('dataset_hoster.test_json'), json=[])
-        self.assert400(resp)
+        self.assert200(resp)
+        self.assertEqual(resp.json, [])
 
     def test_web_get(self):
-        q = SampleQuery()
-        register_query(q)
-        params = { 'in_0':'value0', '[in_1]': 'value1,value2' }
-        resp = self.client.get(url_for('dataset_hoster.test', **params))
+        resp = self.client.get(url_for('dataset_hoster.test', in_0='value0'))
         self.assert200(resp)
+        self.assertIn(b'value0', resp.data)
 
-    def test_web_query_multiple(self):
-        # Check that multiple items can be passed in for a field with "val1,val2"
-        # and that if a value has a , in it, the field can be quoted
-        q = SampleQuery()
-        register_query(q)
-        q.fetch = unittest.mock.Mock()
-        q.fetch.return_value = [{'out_0': 'one', '[out_1]': ['two', 'three']}]
-
-        params = { 'in_0':'value0', '[in_1]': 'value1,value2' }
-        resp = self.client.get(url_for('dataset_hoster.test', **params))
-        q.fetch.assert_called_with([{'in_0': 'value0', '[in_1]': 'value1'}, {'in_0': 'value0', '[in_1]': 'value2'}])
-
-        params = { 'in_0':'value0', '[in_1]': 'value1,"value2,value3"' }
-        resp = self.client.get(url_for('dataset_hoster.test', **params))
-        q.fetch.assert_called_with([{'in_0': 'value0', '[in_1]': 'value1'}, {'in_0': 'value0', '[in_1]': 'value2,value3'}])
+    def test_web_query_fetch(self):
+        with patch.object(sample_query, 'fetch') as fetch:
+            fetch.return_value = [SampleOutputModel(out_0='one', out_1=['two', 'three'])]
+            resp = self.client.get(url_for('dataset_hoster.test', in_0='value0'))
+            fetch.assert_called_once_with([SampleInputModel(in_0='value0')], RequestSource.web)
 
         self.assert200(resp)
+        self.assertIn(b'one', resp.data)
+        self.assertIn(b'three', resp.data)
 
     def test_json_get(self):
-        q = SampleQuery()
-        register_query(q)
-        params = { 'in_0':'value0', '[in_1]': 'value1,value2' }
-        resp = self.client.get(url_for('dataset_hoster.test_json', **params))
+        resp = self.client.get(url_for('dataset_hoster.test_json', in_0='value0'))
         self.assert200(resp)
-        self.assertEqual(len(resp.json), 2)
-        self.assertEqual(resp.json[0]['out_0'], 'value0')
-        self.assertEqual(resp.json[0]['[out_1]'], 'value1')
-        self.assertEqual(resp.json[1]['out_0'], 'value0')
-        self.assertEqual(resp.json[1]['[out_1]'], 'value2')
+        self.assertEqual(resp.json, [{'out_0': 'value0', 'out_1': []}])
 
     def test_json_post(self):
-        q = SampleQuery()
-        register_query(q)
         req_args = [ {
                'in_0': 'value0',
-               '[in_1]': ['value1','value3']
+               'in_1': ['value1','value3']
             }, {
                'in_0': 'value1',
-               '[in_1]': ['value5','value7']
+               'in_1': ['value5','value7']
             }
         ]
         resp = self.client.post(url_for('dataset_hoster.test_json'), json=req_args)
         self.assert200(resp)
         self.assertEqual(len(resp.json), 2)
         self.assertEqual(resp.json[0]['out_0'], 'value0')
-        self.assertEqual(resp.json[0]['[out_1]'], ['value1', 'value3'])
+        self.assertEqual(resp.json[0]['out_1'], ['value1', 'value3'])
         self.assertEqual(resp.json[1]['out_0'], 'value1')
-        self.assertEqual(resp.json[1]['[out_1]'], ['value5', 'value7'])
+        self.assertEqual(resp.json[1]['out_1'], ['value5', 'value7'])
 
     def test_json_post_offset(self):
-        q = SampleQuery()
-        register_query(q)
         req_args = [ {
                'in_0': 'value0',
-               '[in_1]': ['value1','value3']
+               'in_1': ['value1','value3']
             }, {
                'in_0': 'value1',
-               '[in_1]': ['value5','value7']
+               'in_1': ['value5','value7']
             }
         ]
         resp = self.client.post(url_for('dataset_hoster.test_json', offset=1), json=req_args)
         self.assert200(resp)
         self.assertEqual(len(resp.json), 1)
         self.assertEqual(resp.json[0]['out_0'], 'value1')
-        self.assertEqual(resp.json[0]['[out_1]'], ['value5', 'value7'])
+        self.assertEqual(resp.json[0]['out_1'], ['value5', 'value7'])
 
     def test_json_post_count(self):
-        q = SampleQuery()
-        register_query(q)
         req_args = [ {
                'in_0': 'value0',
-               '[in_1]': ['value1','value3']
+               'in_1': ['value1','value3']
             }, {
                'in_0': 'value1',
-               '[in_1]': ['value5','value7']
+               'in_1': ['value5','value7']
             }
         ]
         resp = self.client.post(url_for('dataset_hoster.test_json', count=1), json=req_args)
         self.assert200(resp)
         self.assertEqual(len(resp.json), 1)
         self.assertEqual(resp.json[0]['out_0'], 'value0')
-        self.assertEqual(resp.json[0]['[out_1]'], ['value1', 'value3'])
+        self.assertEqual(resp.json[0]['out_1'], ['value1', 'value3'])
+
+    def test_json_columns_outputs(self):
+        resp = self.client.get(url_for('dataset_hoster.test-columns_json', in_0='value0'))
+        self.assert200(resp)
+        self.assertEqual(resp.json, [{'out_0': 'value0', 'out_1': [], 'out_2': 1}])
+
+    def test_json_subclass_outputs(self):
+        with patch.object(sample_query, 'fetch') as fetch:
+            fetch.return_value = [SampleExtendedOutputModel(out_0='value0', out_1=[], out_2=2)]
+            resp = self.client.get(url_for('dataset_hoster.test_json', in_0='value0'))
+        self.assert200(resp)
+        self.assertEqual(resp.json, [{'out_0': 'value0', 'out_1': [], 'out_2': 2}])
+
+    @patch('datasethoster.main.JSON_STREAM_CHUNK_SIZE', 2)
+    def test_json_post_chunks(self):
+        # no results, exactly one chunk and several chunks with a partial last one
+        for size in (0, 2, 5):
+            req_args = [{'in_0': 'value%d' % i} for i in range(size)]
+            resp = self.client.post(url_for('dataset_hoster.test_json'), json=req_args)
+            self.assert200(resp)
+            self.assertEqual([row['out_0'] for row in resp.json], ['value%d' % i for i in range(size)])
+
+    @patch('datasethoster.main.JSON_STREAM_CHUNK_SIZE', 2)
+    def test_json_post_chunk_error(self):
+        results = [SampleOutputModel(out_0='value%d' % i, out_1=[]) for i in range(3)] + [object()]
+
+        # an error in the first chunk still gets an error response
+        with patch.object(sample_query, 'fetch', return_value=results[2:]):
+            resp = self.client.post(url_for('dataset_hoster.test_json'), json=[{'in_0': 'value0'}])
+        self.assert400(resp)
+
+        # a later chunk fails after the response has started, the error is logged and the response aborted
+        with patch.object(sample_query, 'fetch', return_value=results), \
+                patch('datasethoster.main.logger') as logger, \
+                patch('datasethoster.main.sentry_sdk') as sentry:
+            with self.assertRaises(Exception):
+                self.client.post(url_for('dataset_hoster.test_json'), json=[{'in_0': 'value0'}]).get_data()
+        logger.exception.assert_called_once()
+        sentry.capture_exception.assert_called_once()
+
+    def test_json_post_fetch_error(self):
+        def results():
+            yield SampleOutputModel(out_0='value0', out_1=[])
+            raise ValueError("fetch failed")
+
+        with patch.object(sample_query, 'fetch') as fetch:
+            fetch.return_value = results()
+            resp = self.client.post(url_for('dataset_hoster.test_json'), json=[{'in_0': 'value0'}])
+        self.assert400(resp)
+        self.assertEqual(resp.json, {'error': 'fetch failed'})
+
+    def test_web_offset_count_error(self):
+        resp = self.client.get(url_for('dataset_hoster.test', in_0='value0', offset=1))
+        self.assert200(resp)
+        self.assertIn(b"only supported for the POST method", resp.data)
+
+    def test_web_invalid_pagination(self):
+        resp = self.client.get(url_for('dataset_hoster.test', in_0='value0', count='abc'))
+        self.assert200(resp)
+        self.assertIn(b"The count argument must be an integer.", resp.data)
+
+    def test_blueprint_without_create_app(self):
+        app = Flask(__name__)
+        app.register_blueprint(dataset_bp)
+        resp = app.test_client().get('/test?in_0=value0&count=1')
+        self.assert200(resp)
+        self.assertIn(b"only supported for the POST method", resp.data)
+
+    def test_cache_hit_skips_fetch(self):
+        with patch.object(cached_query, 'fetch', wraps=cached_query.fetch) as fetch:
+            for _ in range(2):
+                resp = self.client.get(url_for('dataset_hoster.test-cached_json', in_0='value0'))
+                self.assert200(resp)
+                self.assertEqual(resp.json, [{'out_0': 'value0', 'out_1': []}])
+            self.assertEqual(fetch.call_count, 1)
+
+            # different inputs are a separate entry
+            resp = self.client.get(url_for('dataset_hoster.test-cached_json', in_0='value1'))
+            self.assertEqual(resp.json, [{'out_0': 'value1', 'out_1': []}])
+            self.assertEqual(fetch.call_count, 2)
+
+    def test_cache_key_separates_sources_and_arguments(self):
+        with patch.object(cached_query, 'fetch', wraps=cached_query.fetch) as fetch:
+            self.client.get(url_for('dataset_hoster.test-cached', in_0='value0'))
+            self.client.get(url_for('dataset_hoster.test-cached_json', in_0='value0'))
+            self.client.post(url_for('dataset_hoster.test-cached_json', count=1), json=[{'in_0': 'value0'}])
+            self.client.post(url_for('dataset_hoster.test-cached_json', count=2), json=[{'in_0': 'value0'}])
+            sources = [c.args[1] for c in fetch.call_args_list]
+            self.assertEqual(sources, [RequestSource.web, RequestSource.json_get,
+                                       RequestSource.json_post, RequestSource.json_post])
+            self.assertEqual([c.kwargs for c in fetch.call_args_list[2:]],
+                             [{'offset': 0, 'count': 1}, {'offset': 0, 'count': 2}])
+
+    def test_cache_stores_encoded_get_response(self):
+        self.client.get(url_for('dataset_hoster.test-cached_json', in_0='value0'))
+        entries = registered_queries['test-cached'].cache.entries
+        self.assertEqual(len(entries), 1)
+        (source, _, _), body = next(iter(entries.items()))
+        self.assertEqual(source, RequestSource.json_get)
+        self.assertEqual(body, b'[{"out_0":"value0","out_1":[]}]')
+
+    def test_no_cache_without_cache_size(self):
+        self.assertIsNone(registered_queries['test'].cache)
+        with patch.object(sample_query, 'fetch', wraps=sample_query.fetch) as fetch:
+            for _ in range(2):
+                self.client.get(url_for('dataset_hoster.test_json', in_0='value0'))
+            self.assertEqual(fetch.call_count, 2)
+
+    def test_json_post_invalid_pagination(self):
+        for args in ({'count': 'abc'}, {'offset': 'x'}):
+            resp = self.client.post(url_for('dataset_hoster.test_json', **args), json=[{'in_0': 'value0'}])
+            self.assert400(resp)
+
+    def test_json_post_invalid_body(self):
+        resp = self.client.post(url_for('dataset_hoster.test_json'), data=b'[{"in_0": ', content_type='application/json')
+        self.assert400(resp)
+
+        resp = self.client.post(url_for('dataset_hoster.test_json'), json={'in_0': 'value0'})
+        self.assert400(resp)
+
+    def test_json_post_any_content_type(self):
+        # the body is parsed as JSON whatever content type the client sends
+        resp = self.client.post(url_for('dataset_hoster.test_json'), data=b'[{"in_0": "value0"}]',
+                                content_type='text/plain')
+        self.assert200(resp)
+        self.assertEqual(resp.json, [{'out_0': 'value0', 'out_1': []}])
+
+    def test_json_post_too_large(self):
+        self.assertEqual(self.app.config['MAX_CONTENT_LENGTH'], DEFAULT_MAX_CONTENT_LENGTH)
+        body = b'[' + b' ' * DEFAULT_MAX_CONTENT_LENGTH + b']'
+        resp = self.client.post(url_for('dataset_hoster.test_json'), data=body, content_type='application/json')
+        self.assertStatus(resp, 413)
+
+    def test_max_content_length_config(self):
+        class Config:
+            MAX_CONTENT_LENGTH = 10
+
+        app = create_app(Config)
+        self.assertEqual(app.config['MAX_CONTENT_LENGTH'], 10)
+        resp = app.test_client().post('/test/json', json=[{'in_0': 'value0'}])
+        self.assertStatus(resp, 413)
+
+        # None disables the limit
+        Config.MAX_CONTENT_LENGTH = None
+        app = create_app(Config)
+        self.assertIsNone(app.config['MAX_CONTENT_LENGTH'])
+        body = b'[' + b' ' * DEFAULT_MAX_CONTENT_LENGTH + b']'
+        resp = app.test_client().post('/test/json', data=body, content_type='application/json')
+        self.assert200(resp)
+        self.assertEqual(resp.json, [])
+
+    def test_web_output_serializers(self):
+        class SerializedOutputModel(SampleOutputModel):
+            @field_serializer('out_0')
+            def serialize_out_0(self, value):
+                return value.upper()
+
+        class ExtraOutputModel(SampleOutputModel):
+            model_config = ConfigDict(extra='allow')
+
+        results = [SerializedOutputModel(out_0='value0', out_1=[])]
+        with patch.object(sample_query, 'fetch', return_value=results):
+            resp = self.client.get(url_for('dataset_hoster.test', in_0='value0'))
+        self.assert200(resp)
+        self.assertIn(b'VALUE0', resp.data)
+
+        results = [ExtraOutputModel(out_0='value0', out_1=[], out_3='extra')]
+        with patch.object(sample_query, 'fetch', return_value=results):
+            with patch('datasethoster.main.render_template', return_value='') as render:
+                self.client.get(url_for('dataset_hoster.test', in_0='value0'))
+        rows = render.call_args.kwargs['results'][0]['data']
+        self.assertEqual(rows, [{'out_0': 'value0', 'out_1': [], 'out_3': 'extra'}])
+
+        # plain models take the instance dict shortcut, but the templates get a copy of it
+        class PlainOutputModel(BaseModel):
+            out_0: str
+
+        results = [PlainOutputModel(out_0='value0')]
+        with patch.object(sample_query, 'fetch', return_value=results):
+            with patch('datasethoster.main.render_template', return_value='') as render:
+                self.client.get(url_for('dataset_hoster.test', in_0='value0'))
+        rows = render.call_args.kwargs['results'][0]['data']
+        self.assertEqual(rows, [{'out_0': 'value0'}])
+        self.assertIsNot(rows[0], results[0].__dict__)
+
+    def test_outputs_adapter_generic_outputs(self):
+        class SampleListOutputsQuery(SampleQuery):
+            def outputs(self):
+                return list[SampleOutputModel]
+
+        # a parametrized generic is not a model, so results are serialized by their runtime type
+        adapter = make_outputs_adapter(SampleListOutputsQuery())
+        results = [SampleExtendedOutputModel(out_0='value0', out_1=[], out_2=1)]
+        self.assertEqual(adapter.dump_json(results), b'[{"out_0":"value0","out_1":[],"out_2":1}]')
+
+    def render_web_results(self, results):
+        """ Run the web query with fetch returning the given results and return the rendered output groups """
+        with patch.object(sample_query, 'fetch', return_value=results):
+            with patch('datasethoster.main.render_template', return_value='') as render:
+                self.client.get(url_for('dataset_hoster.test', in_0='value0'))
+        return render.call_args.kwargs['results']
+
+    def test_web_mixed_results(self):
+        results = [
+            SampleOutputModel(out_0='value0', out_1=[]),
+            SampleOutputModel(out_0='value1', out_1=[]),
+            SampleOtherOutputModel(total=2),
+            SampleOutputModel(out_0='value2', out_1=[]),
+            # same fields as SampleOutputModel, but a different model
+            SampleSameFieldsOutputModel(out_0='value3', out_1=[])
+        ]
+        outputs = self.render_web_results(results)
+        self.assertEqual([(output['columns'], output['data']) for output in outputs], [
+            (['out_0', 'out_1'], [{'out_0': 'value0', 'out_1': []}, {'out_0': 'value1', 'out_1': []}]),
+            (['total'], [{'total': 2}]),
+            (['out_0', 'out_1'], [{'out_0': 'value2', 'out_1': []}]),
+            (['out_0', 'out_1'], [{'out_0': 'value3', 'out_1': []}])
+        ])
+
+    def test_web_uniform_results(self):
+        results = [SampleOutputModel(out_0='value%d' % i, out_1=[]) for i in range(3)]
+        outputs = self.render_web_results(results)
+        self.assertEqual([(output['columns'], output['data']) for output in outputs], [
+            (['out_0', 'out_1'], [{'out_0': 'value%d' % i, 'out_1': []} for i in range(3)])
+        ])
+
+        # the single model fast path groups the same way as the general path
+        mixed = results + [SampleOtherOutputModel(total=3)]
+        self.assertEqual(group_results(results), group_results(mixed)[:1])
+        self.assertEqual(group_results([]), [])
+
+    def test_web_form_widgets(self):
+        resp = self.client.get(url_for('dataset_hoster.test-widgets'))
+        self.assert200(resp)
+        page = resp.data.decode()
+        self.assertIn('<select id="color" name="color">', page)
+        self.assertIn('<select id="shape" name="shape">', page)
+        for choice in ('red', 'blue', 'circle', 'square'):
+            self.assertIn('<option id="%s" name="%s"' % (choice, choice), page)
+        self.assertRegex(page, r'<input type="datetime-local"\s+id="when"')
+
+    def test_web_json_link(self):
+        resp = self.client.get('/test')
+        self.assertIn(b'<a href="/test/json">JSON version</a>', resp.data)
+
+        # the slug in an argument value is left alone
+        resp = self.client.get('/test?in_0=test&in_1=x%2Ftest&dryrun=1')
+        self.assertIn(b'<a href="/test/json?in_0=test&amp;in_1=x%2Ftest&amp;dryrun=1">JSON version</a>', resp.data)
@@ -8,6 +8,15 @@ from pydantic import BaseModel
 from datasethoster import Query
 
 
+X = Enum("X", {"foo": "foo", "bar": "bar"})
+
+
+class ExampleInput(BaseModel):
+    number: int
+    num_lines: int
+    x: X
+
+
 class ExampleOutput(BaseModel):
     number: int
     multiplied: int
@@ -22,7 +31,7 @@ class ExampleOutput2(BaseModel):
     added: int
 
 
-class ExampleQuery(Query[BaseModel, ExampleOutput]):
+class ExampleQuery(Query[ExampleInput, ExampleOutput]):
 
     def setup(self):
         pass
@@ -34,29 +43,18 @@ class ExampleQuery(Query[BaseModel, ExampleOutput]):
         return """This is the introduction, which could provide more useful info that this introduction does."""
 
     def inputs(self):
-        X = Enum("X", {"foo": "foo", "bar": "bar"})
-
-        class ExampleInput(BaseModel):
-            number: int
-            num_lines: int
-            x: X
-
         return ExampleInput
 
     def outputs(self):
         return ExampleOutput
 
-    def fetch(self, params: list, source, offset=-1, count=-1) -> List[ExampleOutput]:
-        data = []
+    def fetch(self, params: List[ExampleInput], source, offset=-1, count=-1) -> List[ExampleOutput]:
+        # the values are computed here, so there is nothing to validate
+        outputs = []
         for param in params:
             number = param.number
             for i in range(1, param.num_lines + 1):
-                data.append({
-                    'number': i,
-                    'multiplied': i * number,
-                    'option': param.x
-                })
-        outputs = [ExampleOutput(number=x["number"], num_lines=x["multiplied"], x=x["option"].value) for x in data]
+                outputs.append(ExampleOutput.model_construct(number=i, multiplied=i * number))
         return outputs
 
 
@@ -75,16 +73,12 @@ class ExampleQuery2(Query[ExampleInput2, ExampleOutput2]):
         return ExampleInput2
 
     def outputs(self):
-        return ExampleOutput
+        return ExampleOutput2
 
     def fetch(self, params: List[ExampleInput2], source, offset=-1, count=-1) -> List[ExampleOutput2]:
-        data = []
+        outputs = []
         for param in params:
             number = param.number
             for i in range(1, param.multiplied + 1):
-                data.append({
-                    'number': i,
-                    'added': i + number
-                })
-        outputs = [ExampleOutput2(number=x["number"], added=x["added"]) for x in data]
+                outputs.append(ExampleOutput2.model_construct(number=i, added=i + number))
         return outputs